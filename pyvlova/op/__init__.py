@@ -5,7 +5,7 @@ from .binary import BinaryChannelwise, BinaryElementwise, ElementwiseAdd, Channe
 from .conv import PlainConv2d, Conv2d
 from .flatten import Flatten2d
 from .grouped_conv import GroupedConv2d, PlainGroupedConv2d
-from .linear import Linear, PlainLinear, PlainBiasedLinear
+from .linear import Linear, PlainLinear, PlainBiasedLinear, PlainLinearInt8
 from .padding import Padding
 from .pool import PlainPool, AdaptivePool, Pool
 from .unary import ReLU, ReLU6, UnaryElementwise
@@ -0,0 +1,60 @@
+# Copyright 2020 Jiang Shenghu
+# SPDX-License-Identifier: Apache-2.0
+import os
+
+try:
+    from numba import njit, prange, config, get_num_threads, set_num_threads
+except ImportError:
+    njit = prange = config = get_num_threads = set_num_threads = None
+
+
+pool_type_ids = {'max': 0, 'avg': 1}
+
+
+def pool_num_threads():
+    try:
+        n = int(os.environ.get('PYVLOVA_NUM_THREADS', ''))
+    except ValueError:
+        n = os.cpu_count() or 1
+    return max(1, min(n, config.NUMBA_NUM_THREADS))
+
+
+def _pool_fwd(x, out, sh, sw, kh, kw, pt, pl, pool_type_id):
+    batch, channel, out_height, out_width = out.shape
+    in_height, in_width = x.shape[2], x.shape[3]
+    init = -float('inf') if pool_type_id == 0 else 0.0
+    # every (n, c) plane is independent, split them over the threads
+    for nc in prange(batch * channel):
+        n, c = nc // channel, nc % channel
+        for h in range(out_height):
+            hb = h * sh - pt
+            acc = out[n, c, h]
+            for w in range(out_width):
+                acc[w] = init
+            # taps outside, output width innermost: each tap is one
+            # vectorizable max/add over a contiguous row of outputs,
+            # taps falling into the padding are clipped off the ranges
+            for i in range(max(0, -hb), min(kh, in_height - hb)):
+                row = x[n, c, hb + i]
+                for j in range(kw):
+                    w_lo = max(0, (pl - j + sw - 1) // sw)
+                    w_hi = min(out_width, (in_width + pl - j + sw - 1) // sw)
+                    if pool_type_id == 0:
+                        for w in range(w_lo, w_hi):
+                            acc[w] = max(acc[w], row[w * sw + j - pl])
+                    else:
+                        for w in range(w_lo, w_hi):
+                            acc[w] += row[w * sw + j - pl]
+            if pool_type_id == 1:
+                scale = 1.0 / (kh * kw)
+                for w in range(out_width):
+                    acc[w] *= scale
+
+
+if njit is not None:
+    # compiled once per argument types and cached on disk, so all pool ops share the same binary;
+    # fastmath without nnan/ninf, max pooling is seeded with -inf
+    pool_fwd = njit(parallel=True, cache=True,
+                    fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})(_pool_fwd)
+else:
+    pool_fwd = None
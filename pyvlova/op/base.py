@@ -26,9 +26,15 @@ class OpParameter(object):
         return '__op_parameter_' + self.name
 
     def mock_poly_tensor(self, instance, tensor: Tensor):
-        setattr(instance, self.hidden_attr, numpy.random.random(tensor.shape).astype(tensor.dtype))
+        if numpy.issubdtype(tensor.dtype, numpy.integer):
+            value = numpy.random.randint(-64, 64, tensor.shape)
+        else:
+            value = numpy.random.random(tensor.shape)
+        setattr(instance, self.hidden_attr, value.astype(tensor.dtype))
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
         value = getattr(instance, self.hidden_attr, None)
         if 'tvm' in calc_mode.mode:
             if 'cuda' in calc_mode.mode:
@@ -136,7 +142,7 @@ class PolyTVMOp(PolyOp):
         assert len(args) <= len(self.inputs)
         assert device and _imp_name
         if _imp_name not in self._imp:
-            getattr(self, 'imp_' + _imp_name)()
+            self._build_imp(_imp_name)
 
         for i, arg in enumerate(args):
             kwargs[self.inputs[i]] = arg
@@ -158,14 +164,17 @@ class PolyTVMOp(PolyOp):
             return outputs[0]
         return tuple(outputs)
 
-    def imp_tvm_llvm(self, te_tensors=None):
+    def _build_imp(self, imp_name, *args, **kwargs):
+        return getattr(self, 'imp_' + imp_name)(*args, **kwargs)
+
+    def imp_tvm_llvm(self, te_tensors=None, schedule=None):
         if te_tensors is None:
             te_tensors = [i.te_tensor for i in self.tensors]
         for i in te_tensors:
             assert i.name in self.tensors
         name = self.name + '_tvm_llvm'
         parser = self.get_parser(factory=ISLNode2TIR)
-        tree = self.schedule.copy()
+        tree = (self.schedule if schedule is None else schedule).copy()
         stmts, tensors = build_tvm_stmts(name, tree, parser, te_tensors=te_tensors)
         assert all((i.name == j.name for i, j in zip(te_tensors, tensors)))
         with tvm.target.Target('llvm'):
@@ -213,7 +222,7 @@ class PolyTVMOp(PolyOp):
 
             def _imp_tvm_timing(*args, timing_number=20, **kwargs):
                 if 'tvm_' + target not in self._imp:
-                    getattr(self, 'imp_tvm_' + target)(*args, **kwargs)
+                    self._build_imp('tvm_' + target, *args, **kwargs)
                 func, arg_map = self._imp['tvm_' + target]
 
                 def timing(*t_args, **t_kwargs):
@@ -268,15 +277,19 @@ class PolyTVMOp(PolyOp):
             os.remove(tmp_file_name)
         return result
 
+    def _topi_cuda_func(self, key):
+        # topi funcs are kept unbound, so per-op overrides live in the instance dict
+        return vars(self).get(key, getattr(type(self), key))
+
     def _build_topi_cuda(self, name, args, te_tensors):
-        res = type(self).topi_cuda_calc_func(*args)
+        res = self._topi_cuda_func('topi_cuda_calc_func')(*args)
         if isinstance(res, tvm.te.Tensor):
             res = (res,)
         named_res = dict(zip(self.topi_cuda_calc_ret_map, res))
         for i in range(len(te_tensors)):
             if te_tensors[i].name in named_res:
                 te_tensors[i] = named_res[te_tensors[i].name]
-        s = type(self).topi_cuda_schedule_func(res)
+        s = self._topi_cuda_func('topi_cuda_schedule_func')(res)
         func = tvm.build(s, te_tensors, name=slugify(name))
         return func
 
@@ -309,6 +322,11 @@ class ArgumentedOp(PolyTVMOp):
     schedule_factory: Callable = None
     tensors_factory: Callable = None
     statements_factory: Callable = None
+    # an optional cpu-specific tree, self.schedule is used by llvm too when it is unset
+    llvm_schedule_factory: Callable = None
+    # set to a dict on ops worth sharing builds, keyed by op type, target, arguments and imp kwargs
+    _compiled_cache: Dict[tuple, Any] = None
+    _compiled_cache_size: int = 64
 
     @classmethod
     def filter_args(cls, args):
@@ -342,10 +360,53 @@ class ArgumentedOp(PolyTVMOp):
             **kwargs
         )
 
+    def _cacheable(self, imp_name):
+        return self._compiled_cache is not None \
+            and imp_name.startswith('tvm_') and not imp_name.endswith('_timing')
+
+    @staticmethod
+    def _freeze(v):
+        if isinstance(v, dict):
+            return tuple(sorted((k, ArgumentedOp._freeze(i)) for k, i in v.items()))
+        if isinstance(v, (list, tuple)):
+            return tuple(map(ArgumentedOp._freeze, v))
+        return v
+
+    def _build_imp(self, imp_name, *args, **kwargs):
+        if not self._cacheable(imp_name):
+            return super()._build_imp(imp_name, *args, **kwargs)
+        # the arguments fix every shape, so ops built from equal arguments and options share one module
+        key = (type(self), imp_name, tuple(self.tensor_order), tuple(sorted(self.arguments.items())),
+               self._freeze(args), self._freeze(kwargs))
+        try:
+            hash(key)
+        except TypeError:
+            return super()._build_imp(imp_name, *args, **kwargs)
+        cache = self._compiled_cache
+        if key in cache:
+            # reinserted to keep the least recently used entry first
+            cache[key] = cache.pop(key)
+        else:
+            super()._build_imp(imp_name, *args, **kwargs)
+            cache[key] = self._imp[imp_name]
+            while len(cache) > self._compiled_cache_size:
+                del cache[next(iter(cache))]
+        self._imp[imp_name] = cache[key]
+        return cache[key][0]
+
+    def imp(self, *args, **kwargs):
+        imp_name = str(calc_mode.mode)
+        if not self._cacheable(imp_name):
+            return super().imp(*args, **kwargs)
+        return self._build_imp(imp_name, *args, **kwargs)
+
     def imp_tvm_llvm(self, te_tensors=None, **kwargs):
         if te_tensors is None:
             te_tensors = [self.tensors[i].te_tensor for i in self.tensor_order]
-        return super().imp_tvm_llvm(te_tensors=te_tensors)
+        schedule = None
+        if type(self).llvm_schedule_factory is not None:
+            schedule = type(self).llvm_schedule_factory(**self.arguments)
+        return super().imp_tvm_llvm(te_tensors=te_tensors, schedule=schedule)
 
     def imp_tvm_cuda(self, te_tensors=None, **kwargs):
         if te_tensors is None:
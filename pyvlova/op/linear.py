@@ -1,26 +1,33 @@
 # Copyright 2020 Jiang Shenghu
 # SPDX-License-Identifier: Apache-2.0
+from functools import lru_cache
+from string import Template
+
+import numpy
+import tvm
 from tvm import topi
 
-from .base import ArgumentedOp, CombinedOp, OpParameter
-from ..poly import TensorTable, ScheduleTree
+from .base import calc_mode, ArgumentedOp, CombinedOp, OpParameter
+from ..poly import TensorTable, ScheduleTree, trace_mode
 
 
-def schedule(**kwargs):
+def _schedule_yaml(blocked=False):
     init_t = 'stmt_init[n, o]'
     calc_t = 'stmt_calc[n, o, i]'
     output_constraints = '0 <= n < batch and 0 <= o < out_channel'
-    calc_constraints = '0 <= i < in_channel'
+    # the i = 0 term is folded into stmt_init
+    calc_constraints = '1 <= i < in_channel'
     domain = '[batch, in_channel, out_channel] -> {' \
              f'{init_t}: {output_constraints}; ' \
              f'{calc_t}: {output_constraints} and {calc_constraints}' \
              '}'
-    outer_schedule = '[%s]' % ', '.join(map(
-        lambda x: f'{{{init_t}->[({x})];{calc_t}->[({x})]}}', ('n', 'o')))
-    inner_schedule = '[%s]' % ', '.join(map(
-        lambda x: f'{{{calc_t}->[({x})]}}', ('i',)))
 
-    tree = ScheduleTree.from_yaml(f'''
+    if not blocked:
+        outer_schedule = '[%s]' % ', '.join(map(
+            lambda x: f'{{{init_t}->[({x})];{calc_t}->[({x})]}}', ('n', 'o')))
+        inner_schedule = '[%s]' % ', '.join(map(
+            lambda x: f'{{{calc_t}->[({x})]}}', ('i',)))
+        return f'''
     domain: "{domain}"
     child:
         schedule: "{outer_schedule}"
@@ -34,45 +41,165 @@ def schedule(**kwargs):
                     schedule: "{inner_schedule}"
                     permutable: 1
                     coincident: [1]
-    ''')
-    tree.apply_params(**dict(filter(lambda x: isinstance(x[1], int), kwargs.items())))
+    '''
+
+    outer_schedule = '[%s]' % ', '.join(map(
+        lambda x: f'{{{init_t}->[({x})];{calc_t}->[({x})]}}', ('n', 'floor(o/$bn)')))
+    init_schedule = '[%s]' % ', '.join(map(
+        lambda x: f'{{{init_t}->[({x})]}}', ('o mod $bn',)))
+    reduce_tile_schedule = '[%s]' % ', '.join(map(
+        lambda x: f'{{{calc_t}->[({x})]}}', ('floor(i/$bk)',)))
+    inner_schedule = '[%s]' % ', '.join(map(
+        lambda x: f'{{{calc_t}->[({x})]}}', ('o mod $bn', 'i mod $bk')))
+
+    return f'''
+    domain: "{domain}"
+    child:
+        schedule: "{outer_schedule}"
+        permutable: 1
+        coincident: [1, 1]
+        child:
+            sequence:
+              - filter: "{{{init_t}}}"
+                child:
+                    schedule: "{init_schedule}"
+                    permutable: 1
+                    coincident: [1]
+              - filter: "{{{calc_t}}}"
+                child:
+                    schedule: "{reduce_tile_schedule}"
+                    permutable: 1
+                    coincident: [0]
+                    child:
+                        schedule: "{inner_schedule}"
+                        permutable: 1
+                        coincident: [1, 0]
+    '''
+
+
+# the yaml is assembled once at import, only the tile sizes of the blocked tree vary
+_LINEAR_YAML = _schedule_yaml()
+_LINEAR_BLOCKED_TEMPLATE = Template(_schedule_yaml(blocked=True))
+
+
+@lru_cache(maxsize=128)
+def _schedule_tree(bn=None, bk=None):
+    if bn is None:
+        return ScheduleTree.from_yaml(_LINEAR_YAML)
+    return ScheduleTree.from_yaml(_LINEAR_BLOCKED_TEMPLATE.substitute(bn=bn, bk=bk))
+
+
+def _apply_params(tree, kwargs):
+    tree = tree.copy()
+    # type() rather than isinstance() to leave out bool flags
+    int_kwargs = {k: v for k, v in kwargs.items() if type(v) is int}
+    tree.apply_params(**int_kwargs)
     return tree
 
 
+def schedule(**kwargs):
+    return _apply_params(_schedule_tree(), kwargs)
+
+
+# gpu threads are mapped onto the outermost band, so the (o, i) cache blocking is for llvm only
+def blocked_schedule(bn=32, bk=256, **kwargs):
+    return _apply_params(_schedule_tree(bn, bk), kwargs)
+
+
+def _numpy_dense(x, weight, out, weight_packed=None):
+    # contiguous operands of the output dtype let numpy hand the product to BLAS gemm
+    x = numpy.ascontiguousarray(x, dtype=out.dtype)
+    if weight_packed is None:
+        weight_packed = numpy.ascontiguousarray(weight, dtype=out.dtype).T
+    return numpy.matmul(x, weight_packed, out=out)
+
+
+class PackedWeightParameter(OpParameter):
+    def __init__(self, name, packed_name):
+        super().__init__(name)
+        self.packed_name = packed_name
+
+    def __set__(self, instance, value):
+        super().__set__(instance, value)
+        vars(instance).pop(self.packed_name, None)
+
+    def packed(self, instance):
+        # the [in_channel, out_channel] gemm operand in the dtype of out, built on the first numpy calc;
+        # a float weight only gets a transposed view, the int8 one is widened into a copy once
+        packed = vars(instance).get(self.packed_name)
+        if packed is None:
+            weight = getattr(instance, self.hidden_attr)
+            packed = numpy.asarray(weight, dtype=instance.linear.tensors['out'].dtype).T
+            setattr(instance, self.packed_name, packed)
+        return packed
+
+
 class PlainBiasedLinear(ArgumentedOp):
     required_args = [
         'in_channel', 'out_channel',
     ]
     optional_args = {
-        'batch': 1,
+        'batch': 1, 'dtype': 'float32', 'use_tensorcore': True,
+        'bn': 32, 'bk': 256,
     }
     tensor_order = ['x', 'weight', 'bias', 'out']
     inputs = ['x', 'weight', 'bias']
     outputs = ['out']
     schedule_factory = schedule
+    llvm_schedule_factory = blocked_schedule
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.topi_cuda_task_name, self.topi_cuda_calc_func, self.topi_cuda_schedule_func = \
+            self.choose_schedule(self.batch, self.dtype, self.in_channel, self.out_channel, self.use_tensorcore)
+
+    @classmethod
+    def choose_schedule(cls, batch, dtype, in_channel=1, out_channel=1, use_tensorcore=True):
+        if batch <= 8 or dtype not in ('float32', 'float16'):
+            return cls.topi_cuda_task_name, cls.topi_cuda_calc_func, cls.topi_cuda_schedule_func
+        if use_tensorcore and dtype == 'float16' \
+                and all(i % 16 == 0 for i in (batch, in_channel, out_channel)):
+            return 'dense_tensorcore.cuda', topi.cuda.dense_tensorcore, topi.cuda.schedule_dense_tensorcore
+        if batch > 64 and tvm.get_global_func('tvm.contrib.cublas.matmul', allow_missing=True):
+            return '', topi.cuda.dense_cublas, topi.cuda.schedule_dense_cublas
+        return 'dense_large_batch.cuda', topi.cuda.dense_large_batch, topi.cuda.schedule_dense_large_batch
 
     @staticmethod
-    def tensors_factory(batch=1, in_channel=1, out_channel=1, **_):
+    def tensors_factory(batch=1, in_channel=1, out_channel=1, dtype='float32', **_):
         table = TensorTable()
-        table.add_tensor('x', [batch, in_channel])
-        table.add_tensor('weight', [out_channel, in_channel])
-        table.add_tensor('bias', [out_channel])
-        table.add_tensor('out', [batch, out_channel])
+        table.add_tensor('x', [batch, in_channel], dtype=dtype)
+        table.add_tensor('weight', [out_channel, in_channel], dtype=dtype)
+        table.add_tensor('bias', [out_channel], dtype=dtype)
+        table.add_tensor('out', [batch, out_channel], dtype=dtype)
         return table
 
     @staticmethod
     def statements_factory(**_):
         def stmt_init(t, n, o):
-            t['out'][n, o] = t['bias'][o]
+            t['out'][n, o] = t['bias'][o] + t['weight'][o, 0] * t['x'][n, 0]
 
         def stmt_calc(t, n, o, i):
             t['out'][n, o] = t['out'][n, o] + t['weight'][o, i] * t['x'][n, i]
 
         return [stmt_init, stmt_calc]
 
+    def imp_numpy(self, *_, **__):
+        pass
+
+    def _numpy_out(self):
+        out = self.tensors['out']
+        return numpy.empty(out.shape, dtype=out.dtype)
+
+    def calc_numpy(self, x, weight, bias, weight_packed=None):
+        out = _numpy_dense(x, weight, self._numpy_out(), weight_packed)
+        out += bias
+        return out
+
     def topi_cuda_args(self, x=None, weight=None, bias=None, out=None):
         return [x, weight, bias]
 
+    _compiled_cache = {}
+
     topi_cuda_task_name = 'dense_small_batch.cuda'
     topi_cuda_calc_func = topi.cuda.dense_small_batch
     topi_cuda_schedule_func = topi.cuda.schedule_dense_small_batch
@@ -84,41 +211,86 @@ class PlainLinear(PlainBiasedLinear):
     inputs = ['x', 'weight']
 
     @staticmethod
-    def tensors_factory(batch=1, in_channel=1, out_channel=1, **_):
+    def tensors_factory(batch=1, in_channel=1, out_channel=1, dtype='float32', **_):
         table = TensorTable()
-        table.add_tensor('x', [batch, in_channel])
-        table.add_tensor('weight', [out_channel, in_channel])
-        table.add_tensor('out', [batch, out_channel])
+        table.add_tensor('x', [batch, in_channel], dtype=dtype)
+        table.add_tensor('weight', [out_channel, in_channel], dtype=dtype)
+        table.add_tensor('out', [batch, out_channel], dtype=dtype)
         return table
 
     @staticmethod
     def statements_factory(**_):
         def stmt_init(t, n, o):
-            t['out'][n, o] = 0.0
+            t['out'][n, o] = t['weight'][o, 0] * t['x'][n, 0]
 
         def stmt_calc(t, n, o, i):
             t['out'][n, o] = t['out'][n, o] + t['weight'][o, i] * t['x'][n, i]
 
         return [stmt_init, stmt_calc]
 
+    def calc_numpy(self, x, weight, weight_packed=None):
+        return _numpy_dense(x, weight, self._numpy_out(), weight_packed)
+
     def topi_cuda_args(self, x=None, weight=None, out=None, **kwargs):
         return [x, weight]
 
 
+class PlainLinearInt8(PlainLinear):
+    optional_args = {**PlainLinear.optional_args, **{
+        'dtype': 'int8',
+    }}
+
+    @staticmethod
+    def tensors_factory(batch=1, in_channel=1, out_channel=1, **_):
+        table = TensorTable()
+        table.add_tensor('x', [batch, in_channel], dtype='int8')
+        table.add_tensor('weight', [out_channel, in_channel], dtype='int8')
+        table.add_tensor('out', [batch, out_channel], dtype='int32')
+        return table
+
+    @staticmethod
+    def statements_factory(**_):
+        def widen(v):
+            if trace_mode.mode == 'tvm':
+                return v.astype('int32')
+            return v
+
+        def stmt_init(t, n, o):
+            t['out'][n, o] = widen(t['weight'][o, 0]) * widen(t['x'][n, 0])
+
+        def stmt_calc(t, n, o, i):
+            t['out'][n, o] = t['out'][n, o] + widen(t['weight'][o, i]) * widen(t['x'][n, i])
+
+        return [stmt_init, stmt_calc]
+
+    def topi_cuda_args(self, x=None, weight=None, out=None, **kwargs):
+        return [x, weight, None, out.dtype]
+
+    topi_cuda_task_name = 'dense_int8.cuda'
+    topi_cuda_calc_func = topi.cuda.dense_int8
+    topi_cuda_schedule_func = topi.cuda.schedule_dense_int8
+
+
 class Linear(CombinedOp):
-    weight = OpParameter('weight')
+    weight = PackedWeightParameter('weight', 'weight_packed')
     bias = OpParameter('bias')
 
-    def __init__(self, batch=1, in_channel=1, out_channel=1, biased=False, name=''):
+    def __init__(self, batch=1, in_channel=1, out_channel=1, biased=False,
+                 dtype='float32', use_tensorcore=True, name=''):
         super().__init__(name=name)
         self.biased = biased
-        if self.biased:
+        self.dtype = dtype
+        if self.dtype == 'int8':
+            assert not self.biased, 'biased int8 linear is not supported'
+            factory = PlainLinearInt8
+        elif self.biased:
             factory = PlainBiasedLinear
         else:
             factory = PlainLinear
         self.linear = factory(
             name=self.name + '.linear', batch=batch,
-            in_channel=in_channel, out_channel=out_channel
+            in_channel=in_channel, out_channel=out_channel,
+            dtype=dtype, use_tensorcore=use_tensorcore
         )
         self._ops.append(self.linear)
         self.weight = self.linear.tensors['weight']
@@ -128,8 +300,11 @@ class Linear(CombinedOp):
             setattr(self, i, getattr(self.linear, i))
 
     def calc(self, x):
+        kwargs = {}
+        if calc_mode.mode == 'numpy':
+            kwargs['weight_packed'] = type(self).weight.packed(self)
         if self.biased:
-            x = self.linear.calc(x, self.weight, self.bias)
+            x = self.linear.calc(x, self.weight, self.bias, **kwargs)
         else:
-            x = self.linear.calc(x, self.weight)
+            x = self.linear.calc(x, self.weight, **kwargs)
         return x
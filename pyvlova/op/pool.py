@@ -1,19 +1,26 @@
 # Copyright 2020 Jiang Shenghu
 # SPDX-License-Identifier: Apache-2.0
+from functools import lru_cache
+from string import Template
+
+import numpy
 from tvm import te, topi
 
+from ._pool_numba import pool_fwd, pool_type_ids, pool_num_threads, get_num_threads, set_num_threads
 from .base import ArgumentedOp, SequenceOp
-from .padding import Padding
 from ..poly import TensorTable, Statement, trace_mode, ScheduleTree
 from ..utils import tir_imm
 
 
-def schedule(pool_type='', **kwargs):
+def _schedule_yaml(pool_type=''):
     init_t = 'stmt_init[n, c, h, w]'
     calc_t = 'stmt_calc[n, c, h, w, i, j]'
     output_constraints = '0 <= n < batch and 0 <= c < channel ' \
                          'and 0 <= h < out_height and 0 <= w < out_width'
-    calc_constraints = '0 <= i < kernel_height and 0 <= j < kernel_width'
+    # taps landing in the padding are cut off the domain instead of reading a padded copy of x
+    calc_constraints = '0 <= i < kernel_height and 0 <= j < kernel_width ' \
+                       'and 0 <= $stride_height * h + i - pad_top < in_height ' \
+                       'and 0 <= $stride_width * w + j - pad_left < in_width'
 
     if pool_type == 'avg':
         avg_div_t = 'stmt_div[n, c, h, w]'
@@ -28,7 +35,7 @@ def schedule(pool_type='', **kwargs):
             lambda x: f'{{{init_t}->[({x})];{calc_t}->[({x})]}}', ('n', 'c', 'h', 'w')))
 
     domain = '[batch, channel, in_height, in_width, out_height, out_width, ' \
-             'kernel_height, kernel_width] -> {' \
+             'kernel_height, kernel_width, pad_top, pad_left] -> {' \
              f'{init_t}: {output_constraints}; ' \
              f'{avg_div_d}' \
              f'{calc_t}: {output_constraints} and {calc_constraints}' \
@@ -36,7 +43,7 @@ def schedule(pool_type='', **kwargs):
     inner_schedule = '[%s]' % ', '.join(map(
         lambda x: f'{{{calc_t}->[({x})]}}', ('i', 'j')))
 
-    tree = ScheduleTree.from_yaml(f'''
+    return f'''
     domain: "{domain}"
     child:
         schedule: "{outer_schedule}"
@@ -51,11 +58,33 @@ def schedule(pool_type='', **kwargs):
                     permutable: 1
                     coincident: [1, 1]
               {avg_div_filter}
-    ''')
-    tree.apply_params(**dict(filter(lambda x: isinstance(x[1], int), kwargs.items())))
+    '''
+
+
+# the yaml only depends on pool_type, so it is assembled once at import;
+# strides multiply loop variables and cannot be isl params, they are substituted per op
+_POOL_TEMPLATE_MAX = Template(_schedule_yaml('max'))
+_POOL_TEMPLATE_AVG = Template(_schedule_yaml('avg'))
+
+
+@lru_cache(maxsize=128)
+def _schedule_tree(pool_type='', stride_height=1, stride_width=1):
+    template = _POOL_TEMPLATE_AVG if pool_type == 'avg' else _POOL_TEMPLATE_MAX
+    return ScheduleTree.from_yaml(template.substitute(stride_height=stride_height, stride_width=stride_width))
+
+
+def schedule(pool_type='', stride_height=1, stride_width=1, pad_top=0, pad_left=0, **kwargs):
+    tree = _schedule_tree(pool_type, stride_height, stride_width).copy()
+    int_kwargs = {k: v for k, v in kwargs.items() if type(v) is int}
+    tree.apply_params(pad_top=pad_top, pad_left=pad_left, **int_kwargs)
     return tree
 
 
+@lru_cache(maxsize=256)
+def _pool_div_const(kernel_height, kernel_width):
+    return tir_imm(float(kernel_height * kernel_width))
+
+
 def tensors(batch=1, channel=1, in_height=1, in_width=1, out_height=1, out_width=1, **_):
     table = TensorTable()
     table.add_tensor('x', [batch, channel, in_height, in_width])
@@ -63,40 +92,66 @@ def tensors(batch=1, channel=1, in_height=1, in_width=1, out_height=1, out_width
     return table
 
 
-def statements(stride_height=1, stride_width=1, kernel_height=1, kernel_width=1, pool_type='max', **_):
+def statements(stride_height=1, stride_width=1, kernel_height=1, kernel_width=1,
+               pad_top=0, pad_left=0, pool_type='max', **_):
+    # the first tap of a window may sit in the padding, so max is seeded with its identity
+    def init_max_tvm(t, n, c, h, w):
+        t['out'][n, c, h, w] = te.min_value(t['out'].dtype)
+
+    def init_max(t, n, c, h, w):
+        t['out'][n, c, h, w] = -float('inf')
+
+    def init_sum(t, n, c, h, w):
+        t['out'][n, c, h, w] = 0.0
+
+    def calc_max_tvm(t, n, c, h, w, i, j):
+        t['out'][n, c, h, w] = te.max(
+            t['out'][n, c, h, w], t['x'][n, c, h * stride_height + i - pad_top, w * stride_width + j - pad_left])
+
+    def calc_max(t, n, c, h, w, i, j):
+        t['out'][n, c, h, w] = max(t['out'][n, c, h, w],
+                                   t['x'][n, c, h * stride_height + i - pad_top, w * stride_width + j - pad_left])
+
+    def calc_sum(t, n, c, h, w, i, j):
+        t['out'][n, c, h, w] = t['out'][n, c, h, w] \
+                               + t['x'][n, c, h * stride_height + i - pad_top, w * stride_width + j - pad_left]
+
+    def calc_tensor_access(t, n, c, h, w, i, j):
+        t['out'][n, c, h, w] = t['x'][n, c, h * stride_height + i - pad_top, w * stride_width + j - pad_left]
+
+    # pool_type is fixed for the op, only trace_mode is left to be resolved per call
+    if pool_type == 'max':
+        init_impl = {'tvm': init_max_tvm}
+        init_default = init_max
+        calc_impl = {'tvm': calc_max_tvm, 'tensor_access': calc_tensor_access}
+        calc_default = calc_max
+    else:
+        init_impl = {}
+        init_default = init_sum
+        calc_impl = {'tvm': calc_sum, 'tensor_access': calc_tensor_access}
+        calc_default = calc_sum
+
     def stmt_init(t, n, c, h, w):
-        if pool_type == 'max':
-            t['out'][n, c, h, w] = t['x'][n, c, h * stride_height, w * stride_height]
-        else:
-            t['out'][n, c, h, w] = 0.0
+        init_impl.get(trace_mode.mode, init_default)(t, n, c, h, w)
 
     def stmt_calc(t, n, c, h, w, i, j):
-        if trace_mode.mode == 'tvm':
-            if pool_type == 'max':
-                t['out'][n, c, h, w] = te.max(
-                    t['out'][n, c, h, w], t['x'][n, c, h * stride_height + i, w * stride_width + j])
-            else:
-                t['out'][n, c, h, w] = t['out'][n, c, h, w] \
-                                       + t['x'][n, c, h * stride_height + i, w * stride_width + j]
-        elif trace_mode.mode == 'tensor_access':
-            t['out'][n, c, h, w] = t['x'][n, c, h * stride_height + i, w * stride_width + j]
-        else:
-            if pool_type == 'max':
-                t['out'][n, c, h, w] = max(t['x'][n, c, h, w],
-                                           t['x'][n, c, h * stride_height + i, w * stride_width + j])
-            else:
-                t['out'][n, c, h, w] = t['out'][n, c, h, w] \
-                                       + t['x'][n, c, h * stride_height + i, w * stride_width + j]
+        calc_impl.get(trace_mode.mode, calc_default)(t, n, c, h, w, i, j)
+
+    window_size = float(kernel_height * kernel_width)
+
+    def div_tvm(t, n, c, h, w):
+        t['out'][n, c, h, w] = t['out'][n, c, h, w] / _pool_div_const(kernel_height, kernel_width)
+
+    def div(t, n, c, h, w):
+        t['out'][n, c, h, w] = t['out'][n, c, h, w] / window_size
+
+    def div_tensor_access(t, n, c, h, w):
+        t['out'][n, c, h, w] = t['out'][n, c, h, w]
+
+    div_impl = {'tvm': div_tvm, 'tensor_access': div_tensor_access}
 
     def stmt_div(t, n, c, h, w):
-        if pool_type != 'avg':
-            return
-        if trace_mode.mode == 'tvm':
-            t['out'][n, c, h, w] = t['out'][n, c, h, w] / tir_imm(float(kernel_height * kernel_width))
-        elif trace_mode.mode == 'tensor_access':
-            t['out'][n, c, h, w] = t['out'][n, c, h, w]
-        else:
-            t['out'][n, c, h, w] = t['out'][n, c, h, w] / float(kernel_height * kernel_width)
+        div_impl.get(trace_mode.mode, div)(t, n, c, h, w)
 
     res = {}
     for f in [stmt_init, stmt_calc]:
@@ -112,11 +167,14 @@ class PlainPool(ArgumentedOp):
         'kernel_height', 'kernel_width', 'pool_type',
     ]
     optional_args = {
-        'batch': 1, 'stride_height': 1, 'stride_width': 1
+        'batch': 1, 'stride_height': 1, 'stride_width': 1,
+        'pad_top': 0, 'pad_bottom': 0, 'pad_left': 0, 'pad_right': 0,
     }
     calculated_args = {
-        'out_height': lambda **a: (a['in_height'] - a['kernel_height']) // a['stride_height'] + 1,
-        'out_width': lambda **a: (a['in_width'] - a['kernel_width']) // a['stride_width'] + 1,
+        'out_height': lambda **a: (a['in_height'] + a['pad_top'] + a['pad_bottom']
+                                   - a['kernel_height']) // a['stride_height'] + 1,
+        'out_width': lambda **a: (a['in_width'] + a['pad_left'] + a['pad_right']
+                                  - a['kernel_width']) // a['stride_width'] + 1,
     }
     tensor_order = ['x', 'out']
     inputs = ['x']
@@ -125,10 +183,52 @@ class PlainPool(ArgumentedOp):
     tensors_factory = tensors
     statements_factory = statements
 
+    def imp_numpy(self, *_, **__):
+        pass
+
+    def calc_numpy(self, x):
+        # AdaptivePool takes no pads
+        pad_top, pad_bottom, pad_left, pad_right = (
+            getattr(self, k, 0) for k in ('pad_top', 'pad_bottom', 'pad_left', 'pad_right'))
+        if pool_fwd is not None:
+            out = numpy.empty(self.tensors['out'].shape, dtype=self.tensors['out'].dtype)
+            # the thread count is numba-global, restore the caller's afterwards
+            num_threads = get_num_threads()
+            set_num_threads(pool_num_threads())
+            try:
+                pool_fwd(numpy.ascontiguousarray(x), out, self.stride_height, self.stride_width,
+                         self.kernel_height, self.kernel_width, pad_top, pad_left,
+                         pool_type_ids[self.pool_type])
+            finally:
+                set_num_threads(num_threads)
+            return out
+
+        reduce = numpy.maximum if self.pool_type == 'max' else numpy.add
+        if pad_top or pad_bottom or pad_left or pad_right:
+            x = numpy.pad(x, [(0, 0), (0, 0), (pad_top, pad_bottom), (pad_left, pad_right)],
+                          constant_values=-numpy.inf if self.pool_type == 'max' else 0)
+
+        def window(i, j):
+            return x[:, :,
+                     i:i + (self.out_height - 1) * self.stride_height + 1:self.stride_height,
+                     j:j + (self.out_width - 1) * self.stride_width + 1:self.stride_width]
+
+        # stmt_init, stmt_calc and stmt_div fused into one accumulation over the kernel window
+        out = window(0, 0).copy()
+        for i in range(self.kernel_height):
+            for j in range(self.kernel_width):
+                if i or j:
+                    reduce(out, window(i, j), out=out)
+        if self.pool_type == 'avg':
+            out /= float(self.kernel_height * self.kernel_width)
+        return out
+
     def topi_cuda_args(self, x=None, out=None):
         return [x, [self.kernel_height, self.kernel_width],
                 [self.stride_height, self.stride_width],
-                [0, 0, 0, 0], self.pool_type]
+                [self.pad_top, self.pad_left, self.pad_bottom, self.pad_right], self.pool_type]
+
+    _compiled_cache = {}
 
     topi_cuda_calc_func = topi.nn.pool
     topi_cuda_schedule_func = lambda outs: topi.cuda.schedule_pool(outs, 'NCHW')
@@ -140,22 +240,13 @@ class Pool(SequenceOp):
                  kernel_height=1, kernel_width=1, stride_height=1, stride_width=1,
                  pad_top=0, pad_bottom=0, pad_left=0, pad_right=0, pool_type='max', name=''):
         super().__init__(name=name)
-        if pad_top or pad_bottom or pad_left or pad_right:
-            self.pad = Padding(
-                name=self.name + '.pad', batch=batch,
-                channel=channel, in_height=in_height, in_width=in_width,
-                pad_top=pad_top, pad_bottom=pad_bottom, pad_left=pad_left, pad_right=pad_right
-            )
-            self._ops.append(self.pad)
-            in_height = self.pad.out_height
-            in_width = self.pad.out_width
-        else:
-            self.pad = None
+        # padding is folded into the pool domain, there is no separate Padding op to copy x through
         self.pool = PlainPool(
             name=self.name + '.pool', batch=batch,
             channel=channel, in_height=in_height, in_width=in_width,
             kernel_height=kernel_height, kernel_width=kernel_width,
             stride_height=stride_height, stride_width=stride_width,
+            pad_top=pad_top, pad_bottom=pad_bottom, pad_left=pad_left, pad_right=pad_right,
             pool_type=pool_type
         )
         self._ops.append(self.pool)
@@ -179,6 +270,21 @@ class AdaptivePool(PlainPool):
         'kernel_width': lambda **a: a['in_width'] - (a['out_width'] - 1) * a['stride_width'],
     }
 
+    @property
+    def is_identity(self):
+        return self.in_height == self.out_height and self.in_width == self.out_width \
+            and self.kernel_height == 1 and self.kernel_width == 1
+
+    def imp(self, *args, **kwargs):
+        if self.is_identity:
+            return None
+        return super().imp(*args, **kwargs)
+
+    def calc(self, x, **kwargs):
+        if self.is_identity:
+            return x
+        return super().calc(x, **kwargs)
+
     def topi_cuda_args(self, x=None, out=None):
         return [x, [self.out_height, self.out_width], self.pool_type]
 
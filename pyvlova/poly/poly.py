@@ -111,6 +111,8 @@ class Tensor(object):
 
     def setitem_tvm(self, key, value):
         assert len(key) == len(self.shape)
+        if isinstance(value, float):
+            value = tir_imm(value, dtype=self.dtype)
         value = tir_imm(value)
         record_effective_op(tir_store(self.te_tensor, key, value))
 
@@ -130,6 +130,19 @@ class Node(object):
         for child in self.children:
             child.parent = self
 
+    def clone(self) -> Node:
+        # isl objects are immutable values and can be shared, only the python structure is duplicated
+        node = copy.copy(self)
+        for k in node.fields:
+            v = getattr(node, k)
+            if isinstance(v, list):
+                setattr(node, k, list(v))
+        node.parent = None
+        node.children = []
+        for child in self.children:
+            node.add_child(child.clone())
+        return node
+
     def get_child(self, i):
         return self.children[i]
 
@@ -20,7 +20,7 @@ class ScheduleTree(object):
         self.root = root
 
     def copy(self) -> ScheduleTree:
-        return type(self).from_yaml(self.to_yaml())
+        return type(self)(self.root.clone() if self.root is not None else None)
 
     @classmethod
     def from_dict(cls, d: Mapping[str, Any]) -> ScheduleTree:
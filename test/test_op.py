@@ -1,9 +1,11 @@
 # Copyright 2020 Jiang Shenghu
 # SPDX-License-Identifier: Apache-2.0
 import unittest
+from unittest import mock
 
 import tvm
 import tvm.testing
+from tvm import topi
 import numpy
 
 from pyvlova.op import *
@@ -34,6 +36,25 @@ class TestOp(unittest.TestCase):
         for u, v in zip(out_a, out_b):
             tvm.testing.assert_allclose(u.asnumpy(), u.asnumpy(), rtol, atol)
 
+    @staticmethod
+    def _random_array(shape, dtype):
+        if numpy.issubdtype(dtype, numpy.integer):
+            return numpy.random.randint(-64, 64, shape).astype(dtype)
+        return numpy.random.random(shape).astype(dtype)
+
+    def _numpy_test_op(self, op, rtol=1e-5, atol=1e-5):
+        args = []
+        for name in op.inputs:
+            tensor = op.tensors[name]
+            args.append(self._random_array(tensor.shape, tensor.dtype))
+        with calc_mode.under('tvm_llvm'):
+            op.imp()
+            out_a = op.calc(*map(tvm.nd.array, args))
+        with calc_mode.under('numpy'):
+            op.imp()
+            out_b = op.calc(*args)
+        tvm.testing.assert_allclose(out_a.asnumpy(), out_b, rtol, atol)
+
     def test_relu(self):
         relu = ReLU(channel=64, height=224, width=224)
         self._cuda_test_op(relu)
@@ -45,6 +66,68 @@ class TestOp(unittest.TestCase):
         )
         self._cuda_test_op(adpavgpool)
 
+    def test_adaptive_pool_identity(self):
+        pool = AdaptivePool(
+            batch=3, channel=16, in_height=7, in_width=7,
+            out_height=7, out_width=7, pool_type='avg'
+        )
+        x = numpy.random.random(pool.tensors['x'].shape).astype('float32')
+        with calc_mode.under('numpy'):
+            pool.imp()
+            self.assertIs(pool.calc(x), x)
+
+    def test_pool_numpy(self):
+        for pool_type in ('max', 'avg'):
+            pool = PlainPool(
+                batch=3, channel=16, in_height=28, in_width=28,
+                kernel_height=3, kernel_width=3, stride_height=2, stride_width=2,
+                pool_type=pool_type
+            )
+            self._numpy_test_op(pool)
+
+    def test_pool_padded_numpy(self):
+        for pool_type in ('max', 'avg'):
+            pool = PlainPool(
+                batch=2, channel=8, in_height=13, in_width=11,
+                kernel_height=3, kernel_width=3, stride_height=2, stride_width=2,
+                pad_top=1, pad_bottom=1, pad_left=1, pad_right=1,
+                pool_type=pool_type
+            )
+            self._numpy_test_op(pool)
+
+    def test_compiled_cache(self):
+        a = PlainLinear(batch=4, in_channel=64, out_channel=32)
+        b = PlainLinear(batch=4, in_channel=64, out_channel=32)
+        c = PlainLinear(batch=8, in_channel=64, out_channel=32)
+        with calc_mode.under('tvm_llvm'):
+            a.imp()
+            b.calc(tvm.nd.array(numpy.random.random([4, 64]).astype('float32')),
+                   tvm.nd.array(numpy.random.random([32, 64]).astype('float32')))
+            c.imp()
+        self.assertIs(a._imp['tvm_llvm'], b._imp['tvm_llvm'])
+        self.assertIsNot(a._imp['tvm_llvm'], c._imp['tvm_llvm'])
+
+        # the way models are built: imp kwargs under a timing mode
+        d = PlainPool(channel=8, in_height=12, in_width=12, kernel_height=2, kernel_width=2, pool_type='max')
+        e = PlainPool(channel=8, in_height=12, in_width=12, kernel_height=2, kernel_width=2, pool_type='max')
+        with calc_mode.under('tvm_llvm_timing'):
+            d.imp(tune_kwargs={'n_trial': n_trials})
+            e.imp(tune_kwargs={'n_trial': n_trials})
+        self.assertIs(d._imp['tvm_llvm'], e._imp['tvm_llvm'])
+
+    def test_pool_numpy_fallback(self):
+        # the numpy window reduction used when numba is not installed
+        with mock.patch('pyvlova.op.pool.pool_fwd', None):
+            for pool_type in ('max', 'avg'):
+                for pad in (0, 1):
+                    pool = PlainPool(
+                        batch=2, channel=8, in_height=13, in_width=11,
+                        kernel_height=3, kernel_width=3, stride_height=2, stride_width=2,
+                        pad_top=pad, pad_bottom=pad, pad_left=pad, pad_right=pad,
+                        pool_type=pool_type
+                    )
+                    self._numpy_test_op(pool)
+
     def test_conv2d(self):
         conv = PlainConv2d(
             batch=5,
@@ -58,6 +141,78 @@ class TestOp(unittest.TestCase):
         linear = PlainLinear(in_channel=64, out_channel=8)
         self._cuda_test_op(linear)
 
+    def test_linear_numpy(self):
+        linear = PlainBiasedLinear(batch=3, in_channel=64, out_channel=8)
+        self._numpy_test_op(linear)
+
+    def test_linear_blocked_numpy(self):
+        # partial bn x bk tiles on both o and i
+        linear = PlainBiasedLinear(batch=3, in_channel=100, out_channel=40, bn=16, bk=32)
+        self._numpy_test_op(linear)
+
+    def test_linear_int8_numpy(self):
+        linear = PlainLinearInt8(batch=3, in_channel=64, out_channel=8)
+        self._numpy_test_op(linear, rtol=0, atol=0)
+
+    def test_linear_packed_weight_numpy(self):
+        for biased, dtype in ((True, 'float32'), (False, 'int8')):
+            linear = Linear(batch=3, in_channel=64, out_channel=8, biased=biased, dtype=dtype)
+            x = self._random_array([3, 64], dtype)
+            with calc_mode.under('tvm_llvm'):
+                linear.imp()
+                out_a = linear.calc(tvm.nd.array(x))
+            with calc_mode.under('numpy'):
+                linear.imp()
+                out_b = linear.calc(x)
+                tvm.testing.assert_allclose(out_a.asnumpy(), out_b, 1e-5, 1e-5)
+
+                # the packed copy follows a re-assigned weight
+                weight = self._random_array([8, 64], dtype)
+                linear.weight = weight
+                expected = numpy.matmul(x.astype(out_b.dtype), weight.T.astype(out_b.dtype))
+                if biased:
+                    expected += linear.bias
+                tvm.testing.assert_allclose(linear.calc(x), expected, 1e-5, 1e-5)
+
+    def test_linear_choose_schedule(self):
+        choose = PlainLinear.choose_schedule
+        default = (PlainLinear.topi_cuda_task_name,
+                   PlainLinear.topi_cuda_calc_func, PlainLinear.topi_cuda_schedule_func)
+        self.assertEqual(default[0], 'dense_small_batch.cuda')
+        self.assertEqual(choose(8, 'float32', 64, 64), default)
+        self.assertEqual(choose(8, 'float16', 64, 64), default)
+        self.assertEqual(choose(32, 'float16', 64, 64),
+                         ('dense_tensorcore.cuda', topi.cuda.dense_tensorcore, topi.cuda.schedule_dense_tensorcore))
+        large_batch = ('dense_large_batch.cuda', topi.cuda.dense_large_batch, topi.cuda.schedule_dense_large_batch)
+        cublas = ('', topi.cuda.dense_cublas, topi.cuda.schedule_dense_cublas)
+        with mock.patch('pyvlova.op.linear.tvm.get_global_func', return_value=None):
+            self.assertEqual(choose(32, 'float16', 64, 64, use_tensorcore=False), large_batch)
+            self.assertEqual(choose(32, 'float16', 60, 64), large_batch)
+            self.assertEqual(choose(128, 'float32', 64, 64), large_batch)
+        with mock.patch('pyvlova.op.linear.tvm.get_global_func', return_value=mock.Mock()):
+            self.assertEqual(choose(128, 'float32', 64, 64), cublas)
+            self.assertEqual(choose(128, 'float16', 64, 60), cublas)
+            self.assertEqual(choose(32, 'float32', 64, 64), large_batch)
+        int8 = PlainLinearInt8(batch=128, in_channel=64, out_channel=64)
+        self.assertEqual(int8.topi_cuda_task_name, 'dense_int8.cuda')
+        self.assertIs(int8._topi_cuda_func('topi_cuda_calc_func'), topi.cuda.dense_int8)
+
+    def test_topi_cuda_func_per_instance(self):
+        with mock.patch('pyvlova.op.linear.tvm.get_global_func', return_value=None):
+            linear = PlainLinear(batch=32, in_channel=64, out_channel=32)
+        self.assertIs(linear._topi_cuda_func('topi_cuda_calc_func'), topi.cuda.dense_large_batch)
+        self.assertIs(linear._topi_cuda_func('topi_cuda_schedule_func'), topi.cuda.schedule_dense_large_batch)
+
+        out = linear.tensors['out'].te_tensor
+        linear.topi_cuda_calc_func = mock.Mock(return_value=out)
+        linear.topi_cuda_schedule_func = mock.Mock(return_value='schedule')
+        te_tensors = [linear.tensors[i].te_tensor for i in linear.tensor_order]
+        with mock.patch('pyvlova.op.base.tvm.build', return_value='func') as build:
+            self.assertEqual(linear._build_topi_cuda('linear', ['x', 'weight'], te_tensors), 'func')
+        linear.topi_cuda_calc_func.assert_called_once_with('x', 'weight')
+        linear.topi_cuda_schedule_func.assert_called_once_with((out,))
+        self.assertEqual(build.call_args[0][0], 'schedule')
+
     def test_grouped_conv2d(self):
         conv = PlainGroupedConv2d(
             batch=7,
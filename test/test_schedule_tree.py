@@ -13,6 +13,15 @@ class TestScheduleTree(unittest.TestCase):
         tree.apply_params(n=1024, m=2048, q=4096)
         cuda_tile(tree, [391, 1096])
 
+    def test_copy(self):
+        tree = example_tree.copy()
+        self.assertEqual(tree.to_yaml(), example_tree.to_yaml())
+        tree.apply_params(n=1024, m=2048, q=4096)
+        tree.outermost_band().coincident[0] = False
+        self.assertNotEqual(tree.to_yaml(), example_tree.to_yaml())
+        self.assertTrue(example_tree.outermost_band().coincident[0])
+        self.assertIn('[n, m, q]', str(example_tree.domain()))
+
 
 if __name__ == '__main__':
     unittest.main()